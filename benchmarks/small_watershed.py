@@ -0,0 +1,108 @@
+"""Time the delineation of a small watershed on a large raster, as completed by the
+Lambda handler: a stream search followed by a snapped delineation.
+
+Synthetic GRASS-style rasters are written to a directory (and reused when present)
+with streams every 64 columns flowing south, and all other cells flowing across to the
+nearest stream. The delineated watershed covers a few thousand cells near the top of
+the raster, so the work should depend on the tiles it touches rather than the size of
+the raster.
+
+Usage:
+    python benchmarks/small_watershed.py [--size 8192] [--open] [--repeat 5]
+"""
+
+import argparse
+import os
+import resource
+import tempfile
+import time
+
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+
+from fastws.watershed import delineate, find_stream
+
+
+# Spacing of stream columns, which sets the width of each watershed
+STREAM_SPACING = 64
+
+# Origin, cell size and spatial reference of the synthetic rasters
+LEFT, TOP, CELL_SIZE, CRS = 1000000, 600000, 10, "EPSG:3005"
+
+
+def write_rasters(directory: str, size: int) -> tuple:
+    paths = tuple(
+        os.path.join(directory, f"{name}_{size}.tif")
+        for name in ("streams", "flow_direction", "flow_accumulation")
+    )
+    if all(os.path.isfile(path) for path in paths):
+        return paths
+
+    cols = np.arange(size) % STREAM_SPACING
+    stream_col = STREAM_SPACING // 2
+    rows = np.arange(size)[:, None]
+
+    # GRASS directions: 6 flows south, 8 flows east and 4 flows west
+    fd = np.broadcast_to(
+        np.where(cols < stream_col, 8, np.where(cols > stream_col, 4, 6)).astype(
+            np.int16
+        ),
+        (size, size),
+    )
+    is_stream = np.broadcast_to(cols == stream_col, (size, size))
+    streams = is_stream.astype(np.uint8)
+    fa = np.where(is_stream, (rows + 1.0) * STREAM_SPACING, -1).astype(np.float32)
+
+    profile = dict(
+        driver="GTiff",
+        height=size,
+        width=size,
+        count=1,
+        crs=CRS,
+        transform=from_origin(LEFT, TOP, CELL_SIZE, CELL_SIZE),
+        tiled=True,
+        blockxsize=256,
+        blockysize=256,
+        compress="deflate",
+    )
+    for path, data, nodata in zip(paths, (streams, fd, fa), (0, 0, -1)):
+        with rasterio.open(path, "w", dtype=data.dtype, nodata=nodata, **profile) as ds:
+            ds.write(data, 1)
+
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--size", type=int, default=8192)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--open", action="store_true", help="Reuse open rasters")
+    parser.add_argument("--dir", default=tempfile.gettempdir())
+    args = parser.parse_args()
+
+    paths = write_rasters(args.dir, args.size)
+    if args.open:
+        from fastws.raster import FlowDirection, Raster
+
+        paths = (Raster(paths[0]), FlowDirection(paths[1]), Raster(paths[2]))
+
+    # A point beside a stream near the top of the raster
+    x, y = LEFT + 10.5 * CELL_SIZE, TOP - 50.5 * CELL_SIZE
+
+    times = []
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        x_snap, y_snap, _ = find_stream(*paths, x, y, CRS)
+        _, _, area, _ = delineate(*paths, x_snap, y_snap, CRS)
+        times.append(time.perf_counter() - start)
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(
+        f"size {args.size} open {args.open} area {area:.0f} "
+        f"first {times[0]:.3f} s median {np.median(times):.3f} s max RSS {rss:.0f} MB"
+    )
+
+
+if __name__ == "__main__":
+    main()
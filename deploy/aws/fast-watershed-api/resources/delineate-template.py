@@ -3,7 +3,8 @@
 import json
 import traceback
 
-from fastws.watershed import find_stream, delineate
+from fastws.raster import FlowDirection, Raster
+from fastws.watershed import find_stream, delineate, warm
 
 
 # Path to a Streams raster
@@ -21,19 +22,43 @@ RESOLUTIONS = []
 # Area thresholds to constrain resolution
 AREA_THRESH = []
 
+# Rasters remain open for the lifetime of the container, along with their caches
+RASTERS = {}
+
+
+def get_rasters(resolution):
+    """Collect the rasters of a resolution, opening them on first use.
+
+    Args:
+        resolution: Resolution used to format the raster paths.
+
+    Returns:
+        tuple: Streams, flow direction and flow accumulation rasters.
+    """
+    if resolution not in RASTERS:
+        RASTERS[resolution] = (
+            Raster(STREAMS_PATH.format(resolution)),
+            FlowDirection(DIRECTION_PATH.format(resolution)),
+            Raster(ACCUMULATION_PATH.format(resolution)),
+        )
+
+    return RASTERS[resolution]
+
 
 def handler(event, context):
     try:
         body = json.loads(event["body"])
 
         if body.get("prime", False):
+            warm()
+            for resolution in RESOLUTIONS:
+                get_rasters(resolution)
+
             result = {"response": "success"}
 
         else:
             x, y, accum_area = find_stream(
-                STREAMS_PATH.format(RESOLUTIONS[0]),
-                DIRECTION_PATH.format(RESOLUTIONS[0]),
-                ACCUMULATION_PATH.format(RESOLUTIONS[0]),
+                *get_rasters(RESOLUTIONS[0]),
                 body["x"],
                 body["y"],
                 body["crs"],
@@ -44,9 +69,7 @@ def handler(event, context):
             ]
 
             x, y, area, geo = delineate(
-                STREAMS_PATH.format(resolution),
-                DIRECTION_PATH.format(resolution),
-                ACCUMULATION_PATH.format(resolution),
+                *get_rasters(resolution),
                 x,
                 y,
                 body["crs"],
@@ -1,13 +1,15 @@
 import numpy as np
+from numba import njit
 from numba.pycc import CC
 
 
 cc = CC("delineate")
 
 
-@cc.export("find_stream_task", "Tuple((b1, i8, i8))(b1[:, :], i2[:, :], i8, i8)")
-def find_stream_task(stream, fd, i, j):
-    directions = [
+# Downstream (row, column) offsets indexed by flow direction, where 0 is off map or
+# no data. Global arrays are frozen into the compiled kernels as constants.
+FD_OFFSETS = np.array(
+    [
         [0, 0],
         [-1, 1],
         [-1, 0],
@@ -17,8 +19,13 @@ def find_stream_task(stream, fd, i, j):
         [1, 0],
         [1, 1],
         [0, 1],
-    ]
+    ],
+    dtype=np.int8,
+)
 
+
+@cc.export("find_stream_task", "Tuple((b1, i8, i8))(b1[:, :], u1[:, :], i8, i8)")
+def find_stream_task(stream, fd, i, j):
     found = False
 
     while True:
@@ -26,14 +33,14 @@ def find_stream_task(stream, fd, i, j):
             found = True
             break
 
-        # Off map
-        if fd[i, j] <= 0:
+        # Off map or no data
+        if fd[i, j] == 0:
             break
 
         # Collect the downstream cell
-        i_offset, j_offset = directions[fd[i, j]]
-        i += i_offset
-        j += j_offset
+        direction = fd[i, j]
+        i += FD_OFFSETS[direction, 0]
+        j += FD_OFFSETS[direction, 1]
 
         if i < 0 or i >= fd.shape[0] or j < 0 or j >= fd.shape[1]:
             break
@@ -41,9 +48,94 @@ def find_stream_task(stream, fd, i, j):
     return found, i, j
 
 
+@njit
+def _grow(a):
+    """Double the capacity of an array along its first axis, preserving contents."""
+    new = np.empty((a.shape[0] * 2,) + a.shape[1:], a.dtype)
+    new[: a.shape[0]] = a
+
+    return new
+
+
+# Neighbour (row, column) offsets, and the flow direction a neighbour must have to
+# contribute to the centre cell
+NEIGHBOURS = (
+    (-1, -1, 7),
+    (-1, 0, 6),
+    (-1, 1, 5),
+    (0, -1, 8),
+    (0, 1, 4),
+    (1, -1, 1),
+    (1, 0, 2),
+    (1, 1, 3),
+)
+
+
+@njit
+def _fill(fd, stack, sp, basin, n_basin, edges, edge_directions, n_edges):
+    """Consume the stack of a delineation until it is empty, or until any buffer may not
+    have room for the neighbours of the next cell. Buffers are never reallocated here,
+    as reassigning arrays within the loop adds reference counting to every iteration.
+
+    Returns:
+        The number of elements in the stack, basin and edge buffers.
+    """
+    nrows, ncols = fd.shape
+    fd1 = fd.reshape(-1)
+
+    while sp > 0:
+        if (
+            sp + 8 > stack.shape[0]
+            or n_basin + 8 > basin.shape[0]
+            or n_edges + 8 > edges.shape[0]
+        ):
+            break
+
+        sp -= 1
+        p = stack[sp]
+        i = p // ncols
+        j = p - i * ncols
+
+        if i > 0 and j > 0 and i < nrows - 1 and j < ncols - 1:
+            # Neighbours of interior cells are checked at constant offsets, without
+            # bounds checks. Cells that flow off the map (0) never match.
+            for d_i, d_j, direction in NEIGHBOURS:
+                q = p + d_i * ncols + d_j
+                if fd1[q] == direction:
+                    stack[sp] = q
+                    sp += 1
+
+                    basin[n_basin, 0] = i + d_i
+                    basin[n_basin, 1] = j + d_j
+                    n_basin += 1
+
+            continue
+
+        for d_i, d_j, direction in NEIGHBOURS:
+            t_i = i + d_i
+            t_j = j + d_j
+
+            # Out of bounds?
+            if t_i < 0 or t_j < 0 or t_i >= nrows or t_j >= ncols:
+                edges[n_edges, 0] = t_i
+                edges[n_edges, 1] = t_j
+                edge_directions[n_edges] = direction
+                n_edges += 1
+
+            elif fd[t_i, t_j] == direction:
+                stack[sp] = t_i * ncols + t_j
+                sp += 1
+
+                basin[n_basin, 0] = t_i
+                basin[n_basin, 1] = t_j
+                n_basin += 1
+
+    return sp, n_basin, n_edges
+
+
 @cc.export(
     "delineate_task",
-    "Tuple((i8[:, :], i8[:, :], i2[:]))(i2[:, :], i8[:, :])",
+    "Tuple((i8[:, :], i8[:, :], u1[:]))(u1[:, ::1], i8[:, :])",
 )
 def delineate_task(fd, stack):
     """Delineate a watershed above a point. If a point out of bounds is encountered, the
@@ -51,45 +143,243 @@ def delineate_task(fd, stack):
     of bounds element.
 
     Args:
-        fd (np.ndarray): 2D flow direction array derived from GRASS GIS.
+        fd (np.ndarray): 2D C-contiguous uint8 flow direction array derived from GRASS
+        GIS, where cells that do not flow to a neighbour are 0.
         stack (np.ndarray): Indexes of elements to try and add to the
         watershed.
 
     Returns:
-        Lists of both watershed
-        cells, and edges encountered.
+        Arrays of watershed cells, edges encountered, and the flow direction into
+        each edge.
     """
-    directions = [[7, 6, 5], [8, 0, 4], [1, 2, 3]]
-    nbrs = [[-1, -1], [-1, 0], [-1, 1], [0, -1], [0, 1], [1, -1], [1, 0], [1, 1]]
+    ncols = fd.shape[1]
+
+    stack_arr = np.empty(max(stack.shape[0] + 8, 1024), np.int64)
+    for k in range(stack.shape[0]):
+        stack_arr[k] = stack[k, 0] * ncols + stack[k, 1]
+    sp = stack.shape[0]
 
-    basin = [[np.int64(0), np.int64(0)]]
-    edges = [[np.int64(0), np.int64(0)]]
-    edge_directions = []
+    basin = np.empty((1024, 2), np.int64)
+    n_basin = 0
 
-    list_stack = [[val for val in e] for e in stack]
+    edges = np.empty((256, 2), np.int64)
+    edge_directions = np.empty(256, np.uint8)
+    n_edges = 0
 
-    while len(list_stack) > 0:
-        i, j = list_stack.pop()
+    # Buffers are grown whenever the fill stops short of consuming the stack
+    while True:
+        sp, n_basin, n_edges = _fill(
+            fd, stack_arr, sp, basin, n_basin, edges, edge_directions, n_edges
+        )
+        if sp == 0:
+            break
 
-        for row_offset, col_offset in nbrs:
-            t_i, t_j = i + row_offset, j + col_offset
+        if sp + 8 > stack_arr.shape[0]:
+            stack_arr = _grow(stack_arr)
+        if n_basin + 8 > basin.shape[0]:
+            basin = _grow(basin)
+        if n_edges + 8 > edges.shape[0]:
+            edges = _grow(edges)
+            edge_directions = _grow(edge_directions)
 
-            # Out of bounds?
-            if t_i < 0 or t_j < 0 or t_i == fd.shape[0] or t_j == fd.shape[0]:
-                edge_directions.append(
-                    np.int16(directions[row_offset + 1][col_offset + 1])
-                )
-                edges.append([t_i, t_j])
+    # Views over the populated rows, which avoid copying the buffers
+    return basin[:n_basin], edges[:n_edges], edge_directions[:n_edges]
+
+
+@cc.export("trace_polygons", "Tuple((i8[:, :], i8[:], i8[:], b1[:]))(u1[:, ::1])")
+def trace_polygons(data):
+    """Trace the boundaries of 4-connected regions of non-zero cells in an array.
+
+    Boundaries are followed along cell edges, keeping the region on the right and
+    turning right where two regions touch diagonally. Rings that would touch
+    themselves are split where they meet, so every ring is simple.
+
+    Args:
+        data (np.ndarray): 2D C-contiguous array where non-zero cells are in a region.
+
+    Returns:
+        Ring vertices as (column, row) cell corners, offsets of each ring into the
+        vertices, the region each ring bounds, and whether each ring is a hole. Rings
+        are closed, and shells are counterclockwise when rows increase downward.
+    """
+    nrows, ncols = data.shape
+    ccols = ncols + 1
+
+    # Label 4-connected regions, using 32-bit labels to limit memory on large grids
+    labels = np.full((nrows, ncols), -1, np.int32)
+    n_labels = 0
+    stack = np.empty(1024, np.int64)
+    for r in range(nrows):
+        for c in range(ncols):
+            if data[r, c] == 0 or labels[r, c] >= 0:
                 continue
 
-            # Flow off map
-            if fd[t_i, t_j] <= 0:
+            labels[r, c] = n_labels
+            stack[0] = r * ncols + c
+            sp = 1
+            while sp > 0:
+                sp -= 1
+                i = stack[sp] // ncols
+                j = stack[sp] - i * ncols
+
+                for t_i, t_j in ((i - 1, j), (i + 1, j), (i, j - 1), (i, j + 1)):
+                    if t_i < 0 or t_j < 0 or t_i >= nrows or t_j >= ncols:
+                        continue
+                    if data[t_i, t_j] == 0 or labels[t_i, t_j] >= 0:
+                        continue
+
+                    labels[t_i, t_j] = n_labels
+                    if sp == stack.shape[0]:
+                        stack = _grow(stack)
+                    stack[sp] = t_i * ncols + t_j
+                    sp += 1
+
+            n_labels += 1
+
+    # Directed boundary edges leaving each corner, as bits of 1 east, 2 south, 4 west
+    # and 8 north, with the region to the right of each edge
+    out = np.zeros((nrows + 1) * ccols, np.uint8)
+    for r in range(nrows):
+        for c in range(ncols):
+            if data[r, c] == 0:
                 continue
+            if r == 0 or data[r - 1, c] == 0:
+                out[r * ccols + c] |= 1
+            if c == ncols - 1 or data[r, c + 1] == 0:
+                out[r * ccols + c + 1] |= 2
+            if r == nrows - 1 or data[r + 1, c] == 0:
+                out[(r + 1) * ccols + c + 1] |= 4
+            if c == 0 or data[r, c - 1] == 0:
+                out[(r + 1) * ccols + c] |= 8
+
+    # Corners where regions touch diagonally are the only ones passed twice
+    saddle = (out == 5) | (out == 10)
+
+    step = np.array([1, ccols, -1, -ccols], np.int64)
+
+    path = np.empty(1024, np.int64)
+    marks = np.empty((64, 2), np.int64)
+
+    vertices = np.empty((1024, 2), np.int64)
+    n_vertices = 0
+    offsets = np.zeros(64, np.int64)
+    ring_labels = np.empty(64, np.int64)
+    holes = np.empty(64, np.bool_)
+    n_rings = 0
+
+    for start in range(out.shape[0]):
+        while out[start]:
+            path[0] = start
+            n_path = 1
+            n_marks = 0
+            cur = start
+            d = -1
+
+            while True:
+                bits = out[cur]
+                if d < 0:
+                    nd = 0
+                    while not bits & (1 << nd):
+                        nd += 1
+                elif bits & (1 << ((d + 1) % 4)):
+                    nd = (d + 1) % 4
+                elif bits & (1 << d):
+                    nd = d
+                else:
+                    nd = (d + 3) % 4
+
+                out[cur] &= ~np.uint8(1 << nd)
+                d = nd
+                nxt = cur + step[nd]
+
+                # Close a ring when returning to a corner already on the path
+                k = -1
+                if nxt == start:
+                    k = 0
+                elif saddle[nxt]:
+                    for m in range(n_marks):
+                        if marks[m, 0] == nxt:
+                            k = marks[m, 1]
+                            break
+
+                if k < 0:
+                    if n_path == path.shape[0]:
+                        path = _grow(path)
+                    path[n_path] = nxt
+                    n_path += 1
+
+                    if saddle[nxt]:
+                        if n_marks == marks.shape[0]:
+                            marks = _grow(marks)
+                        marks[n_marks, 0] = nxt
+                        marks[n_marks, 1] = n_path - 1
+                        n_marks += 1
+
+                    cur = nxt
+                    continue
+
+                # Emit the ring path[k:], keeping only corners where direction changes
+                length = n_path - k
+                area = 0
+                first = n_vertices
+                for t in range(length - 1, -1, -1):
+                    a = path[k + t]
+                    b = path[k + (t + 1) % length]
+                    prev = path[k + (t - 1) % length]
+                    a_i = a // ccols
+                    a_j = a - a_i * ccols
+                    b_i = b // ccols
+                    area += a_j * b_i - (b - b_i * ccols) * a_i
+
+                    if b - a == a - prev:
+                        continue
+
+                    if n_vertices == vertices.shape[0]:
+                        vertices = _grow(vertices)
+                    vertices[n_vertices, 0] = a_j
+                    vertices[n_vertices, 1] = a_i
+                    n_vertices += 1
+
+                if n_vertices == vertices.shape[0]:
+                    vertices = _grow(vertices)
+                vertices[n_vertices] = vertices[first]
+                n_vertices += 1
+
+                # The region to the right of the first edge is bounded by the ring
+                a = path[k]
+                a_i = a // ccols
+                a_j = a - a_i * ccols
+                e = path[k + 1] - a
+                if e == 1:
+                    label = labels[a_i, a_j]
+                elif e == ccols:
+                    label = labels[a_i, a_j - 1]
+                elif e == -1:
+                    label = labels[a_i - 1, a_j - 1]
+                else:
+                    label = labels[a_i - 1, a_j]
+
+                if n_rings + 1 == offsets.shape[0]:
+                    offsets = _grow(offsets)
+                    ring_labels = _grow(ring_labels)
+                    holes = _grow(holes)
+                ring_labels[n_rings] = label
+                holes[n_rings] = area < 0
+                n_rings += 1
+                offsets[n_rings] = n_vertices
+
+                n_path = k + 1
+                while n_marks > 0 and marks[n_marks - 1, 1] > k:
+                    n_marks -= 1
+
+                if n_path == 1 and k == 0:
+                    break
 
-            # Check if the element at this offset contributes to the element being
-            # tested
-            if fd[t_i, t_j] == directions[row_offset + 1][col_offset + 1]:
-                list_stack.append([t_i, t_j])
-                basin.append([t_i, t_j])
+                cur = nxt
 
-    return np.asarray(basin)[1:], np.asarray(edges)[1:], np.asarray(edge_directions)
+    return (
+        vertices[:n_vertices],
+        offsets[: n_rings + 1],
+        ring_labels[:n_rings],
+        holes[:n_rings],
+    )
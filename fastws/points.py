@@ -1,13 +1,83 @@
 """Generate a watersheds polygon file from a vector file of points
 """
 
+import os
+from concurrent.futures import ProcessPoolExecutor
+
 import fiona
+import numpy as np
 
+from fastws.raster import FlowDirection, Raster, get_transformer
 from fastws.watershed import delineate
 
 
+# Rasters and spatial references shared by points delineated in a worker process. The
+# rasters are opened once per worker so their cached windows are reused between points.
+_sources = {}
+
+
+def _init_sources(
+    streams: str, flow_accumulation: str, flow_direction: str, fd_crs, crs
+):
+    _sources.update(
+        streams=Raster(streams),
+        flow_accumulation=Raster(flow_accumulation),
+        flow_direction=FlowDirection(flow_direction),
+        fd_crs=fd_crs,
+        crs=crs,
+    )
+
+
+def _to_point_crs(x: float, y: float, coordinates: list) -> tuple:
+    """Return a snapped point and watershed coordinates to the spatial reference of the
+    input points. The point and all polygon vertices are transformed in a single call.
+    """
+    rings = [ring for polygon in coordinates for ring in polygon]
+    xs, ys = get_transformer(_sources["fd_crs"], _sources["crs"]).transform(
+        *np.concatenate(rings + [[(x, y)]], dtype=float).T
+    )
+    xs, ys = xs.tolist(), ys.tolist()
+
+    start = 0
+    transformed = []
+    for polygon in coordinates:
+        transformed.append([])
+        for ring in polygon:
+            stop = start + len(ring)
+            transformed[-1].append(list(zip(xs[start:stop], ys[start:stop])))
+            start = stop
+
+    return xs[-1], ys[-1], transformed
+
+
+def _one_point(point: dict) -> dict:
+    # Points arrive in the flow direction spatial reference
+    x, y, area, geo = delineate(
+        _sources["streams"],
+        _sources["flow_direction"],
+        _sources["flow_accumulation"],
+        point["coords"][0],
+        point["coords"][1],
+        _sources["fd_crs"],
+        wgs_84=False,
+    )
+
+    x, y, geo["coordinates"] = _to_point_crs(x, y, geo["coordinates"])
+
+    return {
+        "geometry": geo,
+        "properties": dict(point["properties"])
+        | {"fastws_snap_x": x, "fastws_snap_y": y, "fastws_area": area},
+    }
+
+
 def delineate_watersheds(
-    src: str, dst: str, streams: str, flow_accumulation: str, flow_direction: str
+    src: str,
+    dst: str,
+    streams: str,
+    flow_accumulation: str,
+    flow_direction: str,
+    max_workers: int = None,
 ):
     with fiona.open(src) as layer:
         schema = layer.schema
@@ -17,11 +87,28 @@ def delineate_watersheds(
             raise ValueError("Input vector file must have a Point geometry type")
 
         points = [
-            {"coords": feature.geometry.coordinates, "properties": feature.properties}
+            {
+                "coords": tuple(feature.geometry.coordinates),
+                "properties": dict(feature.properties),
+            }
             for feature in layer
             if feature.geometry is not None
         ]
 
+    # Points are reprojected to the flow direction spatial reference in one call, and
+    # results are returned to the spatial reference of the points by the workers
+    with Raster(flow_direction) as fd:
+        fd_crs = fd.proj
+
+    if points:
+        xs, ys = get_transformer(crs, fd_crs).transform(
+            *np.array([point["coords"][:2] for point in points], float).T
+        )
+        for point, x, y in zip(points, xs.tolist(), ys.tolist()):
+            point["coords"] = (x, y)
+
+    max_workers = max_workers or os.cpu_count()
+
     with fiona.open(
         dst,
         "w",
@@ -35,22 +122,13 @@ def delineate_watersheds(
                 "fastws_area": "float",
             },
         },
-    ) as layer:
-        for point in points:
-            x, y, area, geo = delineate(
-                streams,
-                flow_direction,
-                flow_accumulation,
-                point["coords"][0],
-                point["coords"][1],
-                crs,
-                wgs_84=False,
-            )
-
-            layer.write(
-                {
-                    "geometry": geo,
-                    "properties": dict(point["properties"])
-                    | {"fastws_snap_x": x, "fastws_snap_y": y, "fastws_area": area},
-                }
-            )
+    ) as layer, ProcessPoolExecutor(
+        max_workers=max_workers,
+        initializer=_init_sources,
+        initargs=(streams, flow_accumulation, flow_direction, fd_crs, crs),
+    ) as executor:
+        # Points are delineated in parallel, while results are written from this
+        # process in their original order. Each worker receives about four chunks.
+        chunksize = max(1, len(points) // (4 * max_workers))
+        for feature in executor.map(_one_point, points, chunksize=chunksize):
+            layer.write(feature)
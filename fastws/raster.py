@@ -1,36 +1,76 @@
 from __future__ import annotations
+import os
 from typing import Union, Tuple
-from types import SimpleNamespace
+from collections import OrderedDict
+from functools import cached_property, lru_cache
+from contextlib import contextmanager
 
 import numpy as np
 import rasterio
 from rasterio import DatasetReader
 from rasterio.windows import Window
-from pyproj import Transformer
+from pyproj import CRS, Transformer
+
+
+# Number of boolean masks retained by each raster
+MASK_CACHE_SIZE = 64
+
+# Number of data windows retained by each raster
+DATA_CACHE_SIZE = int(os.environ.get("FASTWS_TILE_CACHE", 256))
+
+# Number of transformers retained between pairs of spatial references
+TRANSFORMER_CACHE_SIZE = 64
+
+
+@lru_cache(maxsize=TRANSFORMER_CACHE_SIZE)
+def _get_transformer(s_wkt: str, t_wkt: str) -> Transformer:
+    return Transformer.from_crs(s_wkt, t_wkt, always_xy=True)
+
+
+def get_transformer(
+    s_srs: Union[str, int, dict], t_srs: Union[str, int, dict]
+) -> Transformer:
+    """Collect a transformer between two coordinate systems, which are created once
+    and reused. Spatial references are normalized to WKT before the cache is used, so
+    any form accepted by pyproj (including unhashable dicts) may be provided.
+
+    Args:
+        s_srs (Union[str, int, dict]): Source spatial reference.
+        t_srs (Union[str, int, dict]): Target spatial reference.
+
+    Returns:
+        Transformer: Transformer with x, y axis order.
+    """
+    return _get_transformer(
+        CRS.from_user_input(s_srs).to_wkt(), CRS.from_user_input(t_srs).to_wkt()
+    )
 
 
 def transform_point(
-    x: float, y: float, s_srs: Union[str, int], t_srs: Union[str, int]
+    x: float, y: float, s_srs: Union[str, int, dict], t_srs: Union[str, int, dict]
 ) -> Tuple[float, float]:
     """Reproject a point from one coordinate system to another.
 
     Args:
         x (float): x-coordinate.
         y (float): y-coordinate.
-        s_srs (Union[str, int]): Source spatial reference.
-        t_srs (Union[str, int]): Target spatial reference.
+        s_srs (Union[str, int, dict]): Source spatial reference.
+        t_srs (Union[str, int, dict]): Target spatial reference.
 
     Returns:
         Tuple[float, float]: x and y reprojected
     """
-    transformer = Transformer.from_crs(s_srs, t_srs, always_xy=True)
+    if s_srs == t_srs:
+        return x, y
 
-    return transformer.transform(x, y)
+    return get_transformer(s_srs, t_srs).transform(x, y)
 
 
 class WindowAccumulator:
     """Tracks masked regions of raster windows in the context of the entire extent, and
-    provides a mechanism to collect views into the window data as numpy arrays.
+    provides a mechanism to collect the mask as a numpy array. The mask of each window
+    is stored as packed bits, and is only expanded over the extent of the marked cells
+    when collected.
     """
 
     def __init__(
@@ -40,91 +80,106 @@ class WindowAccumulator:
         self.left = left
         self.csx = csx
         self.csy = csy
-        self.a = np.zeros((init_window.height, init_window.width), bool)
-
-        self.top_accum = self.top - init_window.row_off * self.csy
-        self.bottom_accum = (
-            self.top - (init_window.row_off + init_window.height) * self.csy
-        )
-        self.left_accum = self.left + init_window.col_off * self.csx
-        self.right_accum = (
-            self.left + (init_window.col_off + init_window.width) * self.csx
-        )
 
-        self.windows = {
-            init_window: (slice(0, self.a.shape[0]), slice(0, self.a.shape[1]))
-        }
+        self.windows = {init_window: self.empty_bits(init_window)}
 
     @classmethod
     def from_raster(cls, raster: Raster, window: Window):
         return cls(raster.top, raster.left, raster.csx, raster.csy, window)
 
+    @staticmethod
+    def empty_bits(window: Window) -> np.ndarray:
+        """Allocate a cleared bit mask covering a window.
+
+        Args:
+            window (Window): Window to be covered by the mask.
+
+        Returns:
+            np.ndarray: 1D array of 64-bit words, one bit per cell in row-major order.
+        """
+        return np.zeros(-(-window.height * window.width // 64), np.uint64)
+
     def add_window(self, window: Window):
-        try:
-            self.windows[window]
-        except KeyError:
-            window_top = self.top - window.row_off * self.csy
-            window_bottom = self.top - (window.row_off + window.height) * self.csy
-            window_left = self.left + window.col_off * self.csx
-            window_right = self.left + (window.col_off + window.width) * self.csx
+        if window not in self.windows:
+            self.windows[window] = self.empty_bits(window)
+
+    def set_indices(
+        self,
+        window: Window,
+        i: Union[int, np.ndarray],
+        j: Union[int, np.ndarray],
+    ):
+        """Mark cells of a window that has been added to the accumulator.
 
-            new_top_accum = max(self.top_accum, window_top)
-            new_bottom_accum = min(self.bottom_accum, window_bottom)
-            new_left_accum = min(self.left_accum, window_left)
-            new_right_accum = max(self.right_accum, window_right)
+        Args:
+            window (Window): Window that the indices are relative to.
+            i (Union[int, np.ndarray]): Row index or indices.
+            j (Union[int, np.ndarray]): Column index or indices.
+        """
+        bit = np.asarray(i, np.int64) * window.width + j
 
-            new_a = np.zeros(
-                (
-                    int(round((new_top_accum - new_bottom_accum) / self.csy)),
-                    int(round((new_right_accum - new_left_accum) / self.csx)),
-                ),
-                bool,
-            )
+        np.bitwise_or.at(
+            self.windows[window],
+            bit >> 6,
+            np.left_shift(np.uint64(1), (bit & 63).astype(np.uint64)),
+        )
 
-            top_offset = int(round((new_top_accum - self.top_accum) / self.csy))
-            left_offset = int(round((self.left_accum - new_left_accum) / self.csx))
-
-            new_windows = {
-                window: (
-                    slice(
-                        int(round((new_top_accum - window_top) / self.csy)),
-                        int(round((new_top_accum - window_bottom) / self.csy)),
-                    ),
-                    slice(
-                        int(round((window_left - new_left_accum) / self.csx)),
-                        int(round((window_right - new_left_accum) / self.csx)),
-                    ),
-                )
-            }
+    def __getitem__(self, window: Window) -> np.ndarray:
+        words = self.windows[window].astype("<u8", copy=False)
 
-            for _window, _slice in self.windows.items():
-                new_slice = (
-                    slice(_slice[0].start + top_offset, _slice[0].stop + top_offset),
-                    slice(_slice[1].start + left_offset, _slice[1].stop + left_offset),
-                )
-                new_a[new_slice] = self.a[_slice]
+        return (
+            np.unpackbits(
+                words.view(np.uint8),
+                count=window.height * window.width,
+                bitorder="little",
+            )
+            .reshape(window.height, window.width)
+            .view(bool)
+        )
 
-                new_windows[_window] = new_slice
+    def crop(self, dtype: np.dtype) -> Tuple[np.ndarray, rasterio.Affine]:
+        """Collect the mask over the extent of the marked cells only. Windows are
+        unpacked one at a time, so the accumulated extent is never expanded.
 
-            self.windows = new_windows
-            self.a = new_a
+        Args:
+            dtype (np.dtype): Data type of the output array.
+
+        Returns:
+            Tuple[np.ndarray, rasterio.Affine]: Mask array and its transform.
+        """
+        # Marked cells of each window, in raster (row, column) offsets
+        parts = []
+        for window, words in self.windows.items():
+            if not words.any():
+                continue
+
+            mask = self[window]
+            rows = np.flatnonzero(mask.any(axis=1))
+            cols = np.flatnonzero(mask.any(axis=0))
+            parts.append(
+                (
+                    window.row_off + rows[0],
+                    window.col_off + cols[0],
+                    mask[rows[0] : rows[-1] + 1, cols[0] : cols[-1] + 1],
+                )
+            )
 
-            self.top_accum = new_top_accum
-            self.bottom_accum = new_bottom_accum
-            self.left_accum = new_left_accum
-            self.right_accum = new_right_accum
+        top = min(row for row, _, _ in parts)
+        left = min(col for _, col, _ in parts)
+        bottom = max(row + part.shape[0] for row, _, part in parts)
+        right = max(col + part.shape[1] for _, col, part in parts)
 
-    def __getitem__(self, window: Window) -> np.ndarray:
-        return self.a[self.windows[window]]
+        a = np.zeros((bottom - top, right - left), dtype)
+        for row, col, part in parts:
+            row -= top
+            col -= left
+            a[row : row + part.shape[0], col : col + part.shape[1]] = part
 
-    def astype(self, dtype: np.dtype):
-        return self.a.astype(dtype)
+        transform = rasterio.Affine(
+            self.csx, 0.0, self.left, 0.0, -self.csy, self.top
+        ) * rasterio.Affine.translation(left, top)
 
-    @property
-    def transform(self):
-        return rasterio.Affine(
-            self.csx, 0.0, self.left_accum, 0.0, -self.csy, self.top_accum
-        )
+        return a, transform
 
 
 class Raster:
@@ -134,72 +189,95 @@ class Raster:
         if not self.ds.is_tiled:
             raise ValueError("Input raster should be tiled")
 
-        self.data_cache = {}
+        self.data_cache = OrderedDict()
+        self.mask_cache = OrderedDict()
 
     def __enter__(self) -> DatasetReader:
         return self
 
     def __exit__(self, a, b, c):
-        self.ds.close
+        self.ds.close()
 
-    @property
+    # Dataset properties do not change once opened, so each is only collected once
+    @cached_property
     def transform(self):
         return self.ds.transform
 
-    @property
+    @cached_property
     def shape(self):
         return (self.ds.height, self.ds.width)
 
-    @property
+    @cached_property
     def nodata(self):
         return self.ds.nodatavals[0]
 
-    @property
+    @cached_property
     def proj(self):
         return self.ds.crs
 
-    @property
+    @cached_property
     def left(self):
         return self.ds.bounds.left
 
-    @property
+    @cached_property
     def top(self):
         return self.ds.bounds.top
 
-    @property
+    @cached_property
     def csx(self):
         return self.ds.res[0]
 
-    @property
+    @cached_property
     def csy(self):
         return self.ds.res[1]
 
-    def window_extent(self, window: Window) -> SimpleNamespace:
-        """Collect the bounding coordinates of a given window in the raster.
+    @cached_property
+    def block_shape(self) -> Tuple[int, int]:
+        return self.ds.block_shapes[0]
+
+    def tile_index(self, window: Window) -> Tuple[int, int]:
+        """Collect the (row, column) index of the tile that a window starts in.
 
         Args:
             window (Window): Window within the raster.
 
         Returns:
-            SimpleNamespace: Object with coordinate attributes top, bottom, left, right.
+            Tuple[int, int]: Tile row and column.
         """
-        return SimpleNamespace(
-            top=self.top - window.row_off * self.csy,
-            bottom=self.top - (window.row_off + window.height) * self.csy,
-            left=self.left + window.col_off * self.csx,
-            right=self.left + (window.col_off + window.width) * self.csx,
+        tile_h, tile_w = self.block_shape
+
+        return window.row_off // tile_h, window.col_off // tile_w
+
+    def tile_window(self, row: int, col: int) -> Window:
+        """Construct the window of a tile, clipped to the raster extent.
+
+        Args:
+            row (int): Tile row.
+            col (int): Tile column.
+
+        Returns:
+            Window: Window covering the tile.
+        """
+        tile_h, tile_w = self.block_shape
+        row_off = row * tile_h
+        col_off = col * tile_w
+
+        if row < 0 or col < 0 or row_off >= self.shape[0] or col_off >= self.shape[1]:
+            raise IndexError(f"Tile ({row}, {col}) off of raster map")
+
+        return Window(
+            col_off,
+            row_off,
+            min(tile_w, self.shape[1] - col_off),
+            min(tile_h, self.shape[0] - row_off),
         )
 
     def matches(self, other: Raster) -> bool:
-        return all(
-            [
-                all(
-                    [np.isclose(a, b) for a, b in zip(self.ds.bounds, other.ds.bounds)]
-                ),
-                self.proj == other.proj,
-                self.ds.height == other.ds.height,
-                self.ds.width == other.ds.width,
-            ]
+        # Cheap scalar comparisons short-circuit before the bounds are compared
+        return (
+            self.shape == other.shape
+            and self.proj == other.proj
+            and np.allclose(self.ds.bounds, other.ds.bounds)
         )
 
     def coord_to_idx(self, x: float, y: float) -> Tuple[int, int]:
@@ -231,36 +309,31 @@ class Raster:
             Tuple[Window, int, int]: The resulting window, and the index of (x, y) on
                 the window.
         """
+        try:
+            i, j = self.coord_to_idx(x, y)
+        except IndexError:
+            raise IndexError(f"No window intersects the point ({x}, {y})")
 
-        def intersects(x: float, y: float, window: Window) -> bool:
-            window_ext = self.window_extent(window)
+        return self.index_window(i, j)
 
-            return all(
-                [
-                    y <= window_ext.top,
-                    y >= window_ext.bottom,
-                    x >= window_ext.left,
-                    x <= window_ext.right,
-                ]
-            )
+    def index_window(self, i: int, j: int) -> Tuple[Window, int, int]:
+        """Return the window that intersects a grid index on the raster.
 
-        window = next(
-            (
-                window
-                for _, window in self.ds.block_windows()
-                if intersects(x, y, window)
-            ),
-            None,
-        )
+        Args:
+            i (int): Row index on the raster.
+            j (int): Column index on the raster.
 
-        if window is None:
-            raise IndexError(f"No window intersects the point ({x}, {y})")
+        Returns:
+            Tuple[Window, int, int]: The resulting window, and the index of (i, j) on
+                the window.
+        """
+        if i < 0 or j < 0 or i >= self.shape[0] or j >= self.shape[1]:
+            raise IndexError(f"Index ({i}, {j}) off of raster map")
 
-        window_ext = self.window_extent(window)
-        i = int(np.floor((window_ext.top - y) / self.csy))
-        j = int(np.floor((x - window_ext.left) / self.csx))
+        tile_h, tile_w = self.block_shape
+        window = self.tile_window(i // tile_h, j // tile_w)
 
-        return window, i, j
+        return window, i - window.row_off, j - window.col_off
 
     def xy_from_window_index(
         self, i: int, j: int, window: Window
@@ -276,19 +349,60 @@ class Raster:
         Returns:
             Tuple[float, float]: (x, y) coordinates of the index.
         """
-        window_ext = self.window_extent(window)
+        # Cell centres are offset by half a cell from the raster origin
+        x = self.left + (window.col_off + j + 0.5) * self.csx
+        y = self.top - (window.row_off + i + 0.5) * self.csy
+
+        return x, y
+
+    @staticmethod
+    def window_key(window: Window) -> Tuple[int, int, int, int]:
+        """Collect a hashable key for a window that is cheaper to hash than the window.
+
+        Args:
+            window (Window): Window within the raster.
+
+        Returns:
+            Tuple[int, int, int, int]: Column offset, row offset, width and height.
+        """
+        return window.col_off, window.row_off, window.width, window.height
 
-        half_csy = self.csy / 2.0
-        half_csx = self.csx / 2.0
+    def read(self, window: Window = None) -> np.ndarray:
+        """Read the raster, or a window of it, into memory without caching.
 
-        y = (window_ext.top - i * self.csy) - half_csy
+        Args:
+            window (Window, optional): Window to read. Defaults to None (the entire
+            raster).
 
-        x = (window_ext.left + j * self.csx) + half_csx
+        Returns:
+            np.ndarray: 2D Numpy array of data.
+        """
+        return self.ds.read(1, window=window)
 
-        return x, y
+    def mask(self, window: Window) -> np.ndarray:
+        """Collect a boolean mask of data (not nodata) over a window. The least
+        recently used masks are evicted once MASK_CACHE_SIZE are cached.
+
+        Args:
+            window (Window): A window object used to read data from the source raster.
+
+        Returns:
+            np.ndarray: 2D boolean Numpy array.
+        """
+        key = self.window_key(window)
+        try:
+            self.mask_cache.move_to_end(key)
+        except KeyError:
+            self.mask_cache[key] = self.ds.read(1, window=window) != self.nodata
+
+            if len(self.mask_cache) > MASK_CACHE_SIZE:
+                self.mask_cache.popitem(last=False)
+
+        return self.mask_cache[key]
 
     def __getitem__(self, window: Window) -> np.ndarray:
-        """Collect a window of data.
+        """Collect a window of data. The least recently used windows are evicted once
+        DATA_CACHE_SIZE are cached.
 
         Args:
             s (Window): A window object used to read data from the source raster.
@@ -296,9 +410,68 @@ class Raster:
         Returns:
             np.ndarray: 2D Numpy array of data.
         """
+        key = self.window_key(window)
         try:
-            return self.data_cache[window]
+            self.data_cache.move_to_end(key)
         except KeyError:
-            self.data_cache[window] = self.ds.read(1, window=window)
+            self.data_cache[key] = self.read(window)
+
+            if len(self.data_cache) > DATA_CACHE_SIZE:
+                self.data_cache.popitem(last=False)
+
+        return self.data_cache[key]
 
-        return self.data_cache[window]
+    @cached_property
+    def grid(self) -> np.ndarray:
+        """Data over the entire raster, which is read once and retained for the life of
+        the raster.
+        """
+        return self.read()
+
+    @cached_property
+    def grid_mask(self) -> np.ndarray:
+        """Boolean mask of data (not nodata) over the entire raster, which is computed
+        once and retained for the life of the raster.
+        """
+        return self.ds.read(1) != self.nodata
+
+
+class FlowDirection(Raster):
+    """Flow direction raster derived from GRASS GIS, where data are collected as
+    unsigned bytes. Directions 1 through 8 are retained, while cells that flow off the
+    map or have no data are 0.
+    """
+
+    def read(self, window: Window = None) -> np.ndarray:
+        data = super().read(window)
+
+        # Other values are cleared in place, so no full-size copy is made of the data
+        valid = data >= 1
+        valid &= data <= 8
+        data[~valid] = 0
+
+        return data.astype(np.uint8, copy=False)
+
+
+@contextmanager
+def open_raster(src: Union[str, Raster], cls: type = Raster):
+    """Open a raster source for the duration of a context, or use a Raster that is
+    already open. Rasters that are already open are left open, along with their cached
+    data.
+
+    Args:
+        src (Union[str, Raster]): Raster source or open Raster.
+        cls (type, optional): Raster class used to open a source, which an open Raster
+        must also be an instance of. Defaults to Raster.
+
+    Yields:
+        Raster: Open raster.
+    """
+    if isinstance(src, Raster):
+        if not isinstance(src, cls):
+            raise TypeError(f"Expected an open {cls.__name__} raster")
+
+        yield src
+    else:
+        with cls(src) as raster:
+            yield raster
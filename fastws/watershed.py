@@ -1,69 +1,173 @@
+import os
 from typing import Union, Tuple
+from collections import deque
 
 import numpy as np
-from rasterio.features import shapes
-from pyproj import Transformer
+from rasterio import Affine
+from rasterio.windows import Window
 from shapely.geometry import shape
 
-from fastws.raster import Raster, WindowAccumulator, transform_point
-from .delineate import find_stream_task, delineate_task
+from fastws.raster import (
+    FlowDirection,
+    Raster,
+    WindowAccumulator,
+    get_transformer,
+    open_raster,
+    transform_point,
+)
+from .delineate import find_stream_task, delineate_task, trace_polygons
+
+
+# Rasters with at most this many cells are read whole (once per open raster) when
+# searching for streams and delineating watersheds, while larger rasters are read by tile
+MAX_IN_MEMORY_CELLS = int(os.environ.get("FASTWS_IN_MEMORY_CELLS", 2**20))
+
+
+def warm():
+    """Run each compiled kernel once on a small array so the first request after a
+    cold start does not pay for loading and initializing them.
+    """
+    fd = np.zeros((2, 2), np.uint8)
+    find_stream_task(np.ones((2, 2), bool), fd, 0, 0)
+    delineate_task(fd, np.zeros((1, 2), np.int64))
+    trace_polygons(np.ones((2, 2), np.uint8))
 
 
 def find_stream(
-    stream_src: str, fd_src: str, fa_src: str, x: float, y: float, xy_srs
+    stream_src: Union[str, Raster],
+    fd_src: Union[str, Raster],
+    fa_src: Union[str, Raster],
+    x: float,
+    y: float,
+    xy_srs,
 ) -> Tuple[float, float]:
     """Search for the nearest stream cell and return the central coordinate.
 
     Args:
-        stream_src (str): Raster source of stream data.
-        fd_src (str): Raster source of flow direction data.
-        fa_src (str): Raster source of flow accumulation data. This dataset only
-        requires values where streams occur.
+        stream_src (Union[str, Raster]): Raster source of stream data, or an open
+        Raster.
+        fd_src (Union[str, Raster]): Raster source of flow direction data, or an open
+        FlowDirection.
+        fa_src (Union[str, Raster]): Raster source of flow accumulation data, or an
+        open Raster. This dataset only requires values where streams occur.
         x (float): x-coordinate.
         y (float): y-coordinate.
 
     Returns:
         Tuple[float, float]: (x, y) coordinates that intersect a stream.
     """
-    with Raster(stream_src) as streams, Raster(fd_src) as fd, Raster(fa_src) as fa:
+    with open_raster(stream_src) as streams, open_raster(
+        fd_src, FlowDirection
+    ) as fd, open_raster(fa_src) as fa:
         # Align the point with the grids and move downslope to a stream
         x_transformed, y_transformed = transform_point(x, y, xy_srs, fd.proj)
 
-        window, i, j = fd.intersecting_window(x_transformed, y_transformed)
+        if fd.shape[0] * fd.shape[1] <= MAX_IN_MEMORY_CELLS:
+            # Walk the entire grid at once to avoid hopping between tiles
+            window = Window(0, 0, fd.shape[1], fd.shape[0])
+            i, j = fd.coord_to_idx(x_transformed, y_transformed)
 
-        stream_data = streams[window] != streams.nodata
-        fd_data = fd[window]
+            stream_data = streams.grid_mask
+            fd_data = fd.grid
+        else:
+            window, i, j = fd.intersecting_window(x_transformed, y_transformed)
 
-        if fd_data[i, j] == fd.nodata or fd_data[i, j] <= 0:
+            stream_data = streams.mask(window)
+            fd_data = fd[window]
+
+        if fd_data[i, j] == 0:
             raise ValueError(f"The point ({x}, {y}) is out of bounds")
 
         found, i, j = find_stream_task(stream_data, fd_data, i, j)
         while not found:
+            # The walk stopped inside the data, meaning it flowed off the map
+            if 0 <= i < fd_data.shape[0] and 0 <= j < fd_data.shape[1]:
+                raise ValueError(f"No streams found near the point ({x}, {y})")
+
+            # Resume from the cell beyond the window edge, within a neighbouring tile
             try:
-                window, i, j = fd.intersecting_window(
-                    *fd.xy_from_window_index(i, j, window)
-                )
+                window, i, j = fd.index_window(i + window.row_off, j + window.col_off)
             except IndexError:
                 raise ValueError(f"No streams found near the point ({x}, {y})")
 
-            found, i, j = find_stream_task(
-                streams[window] != streams.nodata, fd[window], i, j
-            )
-
-        area = abs(fa[window][i, j] * fa.csx * fa.csy)
+            fd_data = fd[window]
+            found, i, j = find_stream_task(streams.mask(window), fd_data, i, j)
 
         x, y = fd.xy_from_window_index(i, j, window)
 
+        fa_window, i, j = fa.intersecting_window(x, y)
+        area = abs(fa[fa_window][i, j] * fa.csx * fa.csy)
+
         # Return the x and y coordinates to the original coordinate system
         x, y = transform_point(x, y, fd.proj, xy_srs)
 
         return x, y, area
 
 
+def polygonize(
+    data: np.ndarray, transform: Affine
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, list]:
+    """Trace regions of non-zero cells into polygon rings.
+
+    Args:
+        data (np.ndarray): 2D array where non-zero cells are part of a polygon.
+        transform (Affine): Affine transform of the array.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray, np.ndarray, list]: x and y coordinates of all
+        ring vertices, offsets of each ring into the coordinates, and the rings of each
+        polygon as a shell followed by its holes.
+    """
+    vertices, offsets, labels, holes = trace_polygons(
+        np.ascontiguousarray(data, dtype=np.uint8)
+    )
+
+    xs, ys = transform * (vertices[:, 0], vertices[:, 1])
+
+    # Shells are ordered first so holes may be added to their polygon
+    polygons = {}
+    for ring in np.argsort(holes, kind="stable"):
+        if holes[ring]:
+            polygons[labels[ring]].append(ring)
+        else:
+            polygons[labels[ring]] = [ring]
+
+    return xs, ys, offsets, list(polygons.values())
+
+
+def multipolygon_coordinates(
+    xs: np.ndarray, ys: np.ndarray, offsets: np.ndarray, polygons: list
+) -> list:
+    """Assemble GeoJSON MultiPolygon coordinates from traced rings.
+
+    Args:
+        xs (np.ndarray): x coordinates of all ring vertices.
+        ys (np.ndarray): y coordinates of all ring vertices.
+        offsets (np.ndarray): Offsets of each ring into the coordinates.
+        polygons (list): Rings of each polygon.
+
+    Returns:
+        list: Coordinates of each polygon.
+    """
+    xs, ys = np.asarray(xs).tolist(), np.asarray(ys).tolist()
+    bounds = list(zip(offsets[:-1].tolist(), offsets[1:].tolist()))
+
+    coordinates = []
+    for rings in polygons:
+        polygon = []
+        for ring in rings:
+            start, stop = bounds[ring]
+            polygon.append(list(zip(xs[start:stop], ys[start:stop])))
+
+        coordinates.append(polygon)
+
+    return coordinates
+
+
 def delineate(
-    stream_src: str,
-    fd_src: str,
-    fa_src: str,
+    stream_src: Union[str, Raster],
+    fd_src: Union[str, Raster],
+    fa_src: Union[str, Raster],
     x: float,
     y: float,
     xy_srs: Union[str, int],
@@ -74,10 +178,15 @@ def delineate(
 ) -> Tuple[float, float, float, dict]:
     """Delineate the watershed on a stream above the point (x, y)
 
+    Cells of the watershed are joined into polygons across shared edges only, so cells
+    that touch the rest of the watershed at a corner alone become separate parts of the
+    resulting MultiPolygon.
+
     Args:
-        stream_src (str): Stream raster.
-        fd_src (str): Flow Direction raster.
-        fa_src (str): Flow Accumulation raster.
+        stream_src (Union[str, Raster]): Stream raster source or open Raster.
+        fd_src (Union[str, Raster]): Flow Direction raster source or open
+        FlowDirection.
+        fa_src (Union[str, Raster]): Flow Accumulation raster source or open Raster.
         x (float): X-coordinate for delineation.
         y (float): Y-coordinate for delineation.
         xy_srs (Union[str, int]): Spatial reference of the (x, y) point.
@@ -97,128 +206,148 @@ def delineate(
     if snap:
         x, y, _ = find_stream(stream_src, fd_src, fa_src, x, y, xy_srs)
 
-    with Raster(fd_src) as fd:
+    with open_raster(fd_src, FlowDirection) as fd:
         # Match the point to the raster spatial reference
         x, y = transform_point(x, y, xy_srs, fd.proj)
 
-        def next_delin(stack, window):
+        def next_delin(key):
             # Flow direction data over the extent of the current window
+            window = fd.tile_window(*key)
             data = fd[window]
 
-            # Add contributing cells to the window mask from the stack, and reset
-            cov_idx, edges, edge_dirs = delineate_task(data, np.asarray(stack[window]))
-            stack[window] = []
+            # Add contributing cells to the window mask from the stack, which is
+            # consumed
+            cov_idx, edges, edge_dirs = delineate_task(
+                data, np.concatenate(stacks.pop(key))
+            )
 
             # Add new indices to coverage
-            coverage[window][tuple(cov_idx.T)] = True
+            if cov_idx.size:
+                coverage.set_indices(window, cov_idx[:, 0], cov_idx[:, 1])
 
             # Edge cells are tracked to determine if adjacent windows are needed
             if len(edges) > 0:
-                edges = np.hstack(
-                    [
-                        np.asarray(edge_dirs).reshape((len(edge_dirs), 1)),
-                        np.asarray(edges),
-                    ]
+                # Classify edges by the side(s) of the window they fall off using a
+                # single code: 1 top, 2 bottom, 4 left, 8 right, or a corner sum
+                codes = (
+                    (edges[:, 0] < 0).astype(np.uint8)
+                    | ((edges[:, 0] >= data.shape[0]).astype(np.uint8) << 1)
+                    | ((edges[:, 1] < 0).astype(np.uint8) << 2)
+                    | ((edges[:, 1] >= data.shape[1]).astype(np.uint8) << 3)
                 )
 
-                top_slice = edges[:, 1] < 0
-                bottom_slice = edges[:, 1] == data.shape[0]
-                left_slice = edges[:, 2] < 0
-                right_slice = edges[:, 2] == data.shape[1]
-
-                for bool_slice in (
-                    top_slice & ~left_slice & ~right_slice,
-                    bottom_slice & ~left_slice & ~right_slice,
-                    left_slice & ~top_slice & ~bottom_slice,
-                    right_slice & ~top_slice & ~bottom_slice,
-                    top_slice & left_slice,
-                    top_slice & right_slice,
-                    bottom_slice & left_slice,
-                    bottom_slice & right_slice,
-                ):
-                    if bool_slice.sum() > 0:
-                        edge_subset = edges[bool_slice]
-                        edge_i, edge_j = edge_subset[0, 1:]
-                        try:
-                            next_window, i, j = fd.intersecting_window(
-                                *fd.xy_from_window_index(edge_i, edge_j, window)
-                            )
-                        except IndexError:
-                            # Out of bounds
-                            continue
-
-                        # Align the edge locations with the next window and add
-                        # contributing locations to the respective window stack
-                        edge_subset[:, 1] += i - edge_i
-                        edge_subset[:, 2] += j - edge_j
-
-                        edge_subset = edge_subset[
-                            fd[next_window][(edge_subset[:, 1], edge_subset[:, 2])]
-                            == edge_subset[:, 0]
-                        ][:, 1:]
-
-                        coverage.add_window(next_window)
-
-                        # Add to basin
-                        coverage[next_window][tuple(edge_subset.T)] = True
-
-                        try:
-                            stack[next_window] += edge_subset.tolist()
-                        except KeyError:
-                            stack[next_window] = edge_subset.tolist()
-
-        window, i, j = fd.intersecting_window(x, y)
-        stack = {window: [[i, j]]}
-
-        coverage = WindowAccumulator.from_raster(fd, window)
-        coverage[window][i, j] = True
-
-        while True:
-            next_delin(stack, window)
-
-            window = next(
-                (wind for wind, wind_stack in stack.items() if len(wind_stack) > 0),
-                None,
-            )
+                # Group edges with a matching code into contiguous blocks
+                order = np.argsort(codes, kind="stable")
+                edges = edges[order]
+                edge_dirs = edge_dirs[order]
+                bounds = np.searchsorted(codes[order], np.arange(17))
+
+                for code in np.flatnonzero(np.diff(bounds)).tolist():
+                    # The side code gives the offset to the neighbouring tile
+                    next_key = (
+                        key[0] + (code >> 1 & 1) - (code & 1),
+                        key[1] + (code >> 3 & 1) - (code >> 2 & 1),
+                    )
+                    try:
+                        next_window = fd.tile_window(*next_key)
+                    except IndexError:
+                        # Out of bounds
+                        continue
+
+                    # Align the edge locations with the next window and add
+                    # contributing locations to the respective window stack
+                    edge_subset = edges[bounds[code] : bounds[code + 1]]
+                    edge_subset += (
+                        window.row_off - next_window.row_off,
+                        window.col_off - next_window.col_off,
+                    )
+
+                    next_data = fd[next_window]
+                    edge_subset = edge_subset[
+                        np.take(
+                            next_data,
+                            edge_subset[:, 0] * next_data.shape[1] + edge_subset[:, 1],
+                        )
+                        == edge_dirs[bounds[code] : bounds[code + 1]]
+                    ]
 
-            if window is None:
-                break
+                    if len(edge_subset) == 0:
+                        continue
 
-        # Create a GeoJSON
-        watershed_geom = {"type": "MultiPolygon", "coordinates": []}
-
-        for geo, value in shapes(
-            coverage.astype(np.uint8), connectivity=8, transform=coverage.transform
-        ):
-            if value == 1:
-                watershed_geom["coordinates"].append(geo["coordinates"])
-
-        # Calculate area
-        watershed_shape = shape(watershed_geom)
-        if simplify > 0:
-            watershed_shape = watershed_shape.simplify(tolerance=simplify)
-
-        if smooth > 0:
-            watershed_shape = watershed_shape.buffer(smooth, join_style=1).buffer(
-                -smooth, join_style=1
-            )
+                    coverage.add_window(next_window)
 
-        area = watershed_shape.area
+                    # Add to basin
+                    coverage.set_indices(
+                        next_window, edge_subset[:, 0], edge_subset[:, 1]
+                    )
 
-        if wgs_84:
-            transformer = Transformer.from_crs(fd.proj, 4326, always_xy=True)
+                    # Tiles are queued when their stack is first populated
+                    try:
+                        stacks[next_key].append(edge_subset)
+                    except KeyError:
+                        stacks[next_key] = [edge_subset]
+                        ready.append(next_key)
+
+        if fd.shape[0] * fd.shape[1] <= MAX_IN_MEMORY_CELLS:
+            # Delineate over the entire grid in a single pass rather than by tile
+            seed = np.array([fd.coord_to_idx(x, y)], np.int64)
+            cov_idx = np.vstack([seed, delineate_task(fd.grid, seed)[0]])
+
+            # Coverage is only allocated over the extent of the watershed
+            top, left = cov_idx.min(axis=0)
+            bottom, right = cov_idx.max(axis=0) + 1
+            coverage_data = np.zeros((bottom - top, right - left), np.uint8)
+            coverage_data[cov_idx[:, 0] - top, cov_idx[:, 1] - left] = 1
+            coverage_transform = fd.transform * Affine.translation(left, top)
+
+        else:
+            window, i, j = fd.intersecting_window(x, y)
+
+            # Stacks of cells to evaluate are keyed by tile (row, column) and hold
+            # arrays of (i, j) indices that are concatenated when the tile is delineated
+            key = fd.tile_index(window)
+            stacks = {key: [np.array([[i, j]], np.int64)]}
+            ready = deque([key])
+
+            coverage = WindowAccumulator.from_raster(fd, window)
+            coverage.set_indices(window, i, j)
 
-            def transform_coords(coords):
-                wgs_pnts = transformer.transform(
-                    [coord[0] for coord in coords[0]],
-                    [coord[1] for coord in coords[0]],
+            while ready:
+                next_delin(ready.popleft())
+
+            # Only the extent of the watershed is collected for polygonizing
+            coverage_data, coverage_transform = coverage.crop(np.uint8)
+
+        # Create a GeoJSON
+        xs, ys, offsets, polygons = polygonize(coverage_data, coverage_transform)
+        watershed_geom = {
+            "type": "MultiPolygon",
+            "coordinates": multipolygon_coordinates(xs, ys, offsets, polygons),
+        }
+
+        # Calculate area, which is exact from the number of cells unless the geometry
+        # is altered
+        if simplify > 0 or smooth > 0:
+            watershed_shape = shape(watershed_geom)
+            if simplify > 0:
+                watershed_shape = watershed_shape.simplify(tolerance=simplify)
+
+            if smooth > 0:
+                watershed_shape = watershed_shape.buffer(smooth, join_style=1).buffer(
+                    -smooth, join_style=1
                 )
 
-                return [list(zip(*wgs_pnts))]
+            area = watershed_shape.area
 
-            watershed_geom["coordinates"] = [
-                transform_coords(coords) for coords in watershed_geom["coordinates"]
-            ]
+        else:
+            area = float(np.count_nonzero(coverage_data) * fd.csx * fd.csy)
+
+        if wgs_84:
+            # All vertices are transformed in a single call
+            xs, ys = get_transformer(fd.proj, 4326).transform(xs, ys)
+            watershed_geom["coordinates"] = multipolygon_coordinates(
+                xs, ys, offsets, polygons
+            )
 
         # Return the x and y coordinates to the original coordinate system
         x, y = transform_point(x, y, fd.proj, xy_srs)
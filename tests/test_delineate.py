@@ -0,0 +1,203 @@
+from collections import defaultdict
+
+import numpy as np
+import pytest
+import rasterio
+from rasterio.features import shapes
+from rasterio.transform import from_origin
+from shapely.geometry import shape
+from shapely.ops import unary_union
+
+from fastws import watershed
+from fastws.delineate import delineate_task
+from fastws.watershed import delineate
+
+
+# Downstream (row, column) offsets of GRASS flow directions
+OFFSETS = {
+    1: (-1, 1),
+    2: (-1, 0),
+    3: (-1, -1),
+    4: (0, -1),
+    5: (1, -1),
+    6: (1, 0),
+    7: (1, 1),
+    8: (0, 1),
+}
+
+# Origin, cell size and spatial reference of rasters written for tests
+LEFT, TOP, CELL_SIZE, CRS = 1000000, 600000, 10, "EPSG:3005"
+
+
+def random_flow_direction(shape, rng):
+    """Flow directions without cycles that drain towards the top left, where each cell
+    flows to a random neighbour with a lower potential
+    """
+    potential = np.add.outer(np.arange(shape[0]), 0.3 * np.arange(shape[1]))
+    potential += rng.uniform(0, 2, shape)
+    padded = np.pad(potential, 1, constant_values=np.inf)
+
+    directions = np.array(list(OFFSETS))
+    neighbours = np.stack(
+        [
+            padded[1 + di : 1 + di + shape[0], 1 + dj : 1 + dj + shape[1]]
+            for di, dj in OFFSETS.values()
+        ]
+    )
+    lower = neighbours < potential
+    choice = np.where(lower, rng.random(lower.shape), -1).argmax(axis=0)
+    fd = np.where(lower.any(axis=0), directions[choice], 0).astype(np.uint8)
+
+    # Scattered no data
+    fd[rng.random(shape) < 0.01] = 0
+
+    return fd, potential
+
+
+def brute_force_upstream(fd, seed):
+    """Mask of the seed and all cells that flow into it, from a breadth-first search"""
+    contributors = defaultdict(list)
+    for (i, j), direction in np.ndenumerate(fd):
+        if direction in OFFSETS:
+            di, dj = OFFSETS[direction]
+            contributors[(i + di, j + dj)].append((i, j))
+
+    mask = np.zeros(fd.shape, bool)
+    mask[seed] = True
+    queue = [seed]
+    while queue:
+        for cell in contributors[queue.pop()]:
+            if not mask[cell]:
+                mask[cell] = True
+                queue.append(cell)
+
+    return mask
+
+
+def largest_outlet(fd, potential):
+    """Cell with the largest number of upstream cells"""
+    accumulation = np.ones(fd.shape, np.int64)
+    for flat in np.argsort(potential, axis=None)[::-1].tolist():
+        i, j = divmod(flat, fd.shape[1])
+        if fd[i, j] in OFFSETS:
+            di, dj = OFFSETS[fd[i, j]]
+            if 0 <= i + di < fd.shape[0] and 0 <= j + dj < fd.shape[1]:
+                accumulation[i + di, j + dj] += accumulation[i, j]
+
+    return np.unravel_index(accumulation.argmax(), fd.shape)
+
+
+def check_delineate_task(fd, seed):
+    basin, edges, edge_dirs = delineate_task(fd, np.array([seed], np.int64))
+
+    # The basin excludes the seed, and every cell is added once
+    expected = brute_force_upstream(fd, seed)
+    covered = np.zeros(fd.shape, bool)
+    covered[seed] = True
+    covered[basin[:, 0], basin[:, 1]] = True
+
+    assert len(basin) == expected.sum() - 1
+    np.testing.assert_array_equal(covered, expected)
+
+    # Edges lie off the array and would flow into the basin
+    outside = (
+        (edges[:, 0] < 0)
+        | (edges[:, 0] >= fd.shape[0])
+        | (edges[:, 1] < 0)
+        | (edges[:, 1] >= fd.shape[1])
+    )
+    assert outside.all()
+    for (i, j), direction in zip(edges.tolist(), edge_dirs.tolist()):
+        di, dj = OFFSETS[direction]
+        assert expected[i + di, j + dj]
+
+
+@pytest.mark.parametrize(
+    "raster_shape", [(250, 230), (64, 64), (1, 40), (37, 1), (3, 3)]
+)
+def test_delineate_task_random(raster_shape):
+    rng = np.random.default_rng(raster_shape[0] * 1000 + raster_shape[1])
+    fd, potential = random_flow_direction(raster_shape, rng)
+
+    seeds = [largest_outlet(fd, potential)] + [
+        tuple(cell) for cell in rng.integers(0, raster_shape, (5, 2)).tolist()
+    ]
+    for seed in seeds:
+        check_delineate_task(fd, tuple(int(v) for v in seed))
+
+
+def test_delineate_task_grows_buffers():
+    # Cells flow west into the first column, which flows north to the seed. The basin,
+    # stack of pending cells and edges each outgrow their initial capacity.
+    fd = np.full((2000, 50), 4, np.uint8)
+    fd[:, 0] = 2
+    fd[0, 0] = 0
+
+    check_delineate_task(fd, (0, 0))
+
+    # Cells flow north into the first row, which flows west to the seed
+    fd = np.full((300, 400), 2, np.uint8)
+    fd[0] = 4
+    fd[0, 0] = 0
+
+    check_delineate_task(fd, (0, 0))
+
+
+def write_flow_direction(path, fd):
+    """Write a GRASS-style flow direction raster with 64 x 64 tiles"""
+    with rasterio.open(
+        path,
+        "w",
+        driver="GTiff",
+        height=fd.shape[0],
+        width=fd.shape[1],
+        count=1,
+        dtype=np.int16,
+        crs=CRS,
+        transform=from_origin(LEFT, TOP, CELL_SIZE, CELL_SIZE),
+        tiled=True,
+        blockxsize=64,
+        blockysize=64,
+    ) as ds:
+        ds.write(fd.astype(np.int16), 1)
+
+
+@pytest.mark.parametrize("max_in_memory_cells", [0, 2**26])
+@pytest.mark.parametrize("raster_shape", [(250, 230), (64, 200), (130, 100)])
+def test_delineate_matches_brute_force(
+    tmp_path, monkeypatch, raster_shape, max_in_memory_cells
+):
+    monkeypatch.setattr(watershed, "MAX_IN_MEMORY_CELLS", max_in_memory_cells)
+
+    rng = np.random.default_rng(raster_shape[0] * 1000 + raster_shape[1])
+    fd, potential = random_flow_direction(raster_shape, rng)
+
+    # Negative GRASS directions flow off the map, and are read as no data
+    grass_fd = fd.astype(np.int16)
+    grass_fd[rng.random(raster_shape) < 0.005] = -4
+    path = str(tmp_path / "fd.tif")
+    write_flow_direction(path, grass_fd)
+    fd[grass_fd < 0] = 0
+
+    seeds = [largest_outlet(fd, potential)] + [
+        tuple(cell) for cell in rng.integers(0, raster_shape, (3, 2)).tolist()
+    ]
+    for i, j in seeds:
+        x, y = LEFT + (j + 0.5) * CELL_SIZE, TOP - (i + 0.5) * CELL_SIZE
+        _, _, area, geo = delineate(None, path, None, x, y, CRS, False, False)
+
+        expected = brute_force_upstream(fd, (int(i), int(j)))
+        expected_shape = unary_union(
+            [
+                shape(geometry)
+                for geometry, _ in shapes(
+                    expected.astype(np.uint8),
+                    mask=expected,
+                    transform=from_origin(LEFT, TOP, CELL_SIZE, CELL_SIZE),
+                )
+            ]
+        )
+
+        assert area == expected.sum() * CELL_SIZE**2
+        assert shape(geo).is_valid
+        assert shape(geo).symmetric_difference(expected_shape).area == 0
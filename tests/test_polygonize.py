@@ -0,0 +1,108 @@
+import numpy as np
+import pytest
+from rasterio.features import shapes
+from rasterio.transform import from_origin
+from shapely.geometry import shape
+from shapely.ops import unary_union
+
+from fastws.watershed import multipolygon_coordinates, polygonize
+
+
+# Transform of traced masks, with integer coordinates so areas are exact
+TRANSFORM = from_origin(1000000, 600000, 10, 10)
+
+
+def trace(mask):
+    """Trace a mask into a shapely MultiPolygon"""
+    xs, ys, offsets, polygons = polygonize(mask.astype(np.uint8), TRANSFORM)
+
+    return shape(
+        {
+            "type": "MultiPolygon",
+            "coordinates": multipolygon_coordinates(xs, ys, offsets, polygons),
+        }
+    )
+
+
+def check_against_shapes(mask):
+    geometry = trace(mask)
+
+    # Parts of the reference are the 4-connected regions of the mask
+    reference = [
+        shape(polygon)
+        for polygon, _ in shapes(
+            mask.astype(np.uint8), mask=mask, connectivity=4, transform=TRANSFORM
+        )
+    ]
+
+    assert geometry.is_valid
+    assert all(part.is_valid for part in geometry.geoms)
+    assert geometry.area == mask.sum() * 100
+    assert len(geometry.geoms) == len(reference)
+    assert sorted(part.area for part in geometry.geoms) == sorted(
+        part.area for part in reference
+    )
+    assert geometry.symmetric_difference(unary_union(reference)).area == 0
+
+    return geometry
+
+
+MASKS = {
+    "single cell": np.array([[1]]),
+    "single cell with margin": np.pad([[1]], 1),
+    "checkerboard": np.indices((6, 7)).sum(axis=0) % 2,
+    "ring": np.pad(np.pad([[0]], 2, constant_values=1), 1),
+    "holes touching at a corner": np.pad(
+        np.array(
+            [
+                [1, 1, 1, 1],
+                [1, 0, 1, 1],
+                [1, 1, 0, 1],
+                [1, 1, 1, 1],
+            ]
+        ),
+        1,
+    ),
+    "hole touching the outside at a corner": np.array(
+        [
+            [0, 1, 1, 1],
+            [1, 0, 1, 1],
+            [1, 1, 1, 1],
+        ]
+    ),
+    "island in a hole": np.pad(np.pad(np.pad([[1]], 1), 1, constant_values=1), 1),
+    "diagonal cells": np.eye(5),
+}
+
+
+@pytest.mark.parametrize("name", list(MASKS))
+def test_polygonize_masks(name):
+    check_against_shapes(MASKS[name].astype(bool))
+
+
+def test_polygonize_holes():
+    geometry = check_against_shapes(MASKS["ring"].astype(bool))
+    assert len(geometry.geoms) == 1
+    assert len(geometry.geoms[0].interiors) == 1
+
+    geometry = check_against_shapes(MASKS["island in a hole"].astype(bool))
+    assert len(geometry.geoms) == 2
+    assert sorted(len(part.interiors) for part in geometry.geoms) == [0, 1]
+
+
+def test_polygonize_diagonal_cells_are_separate_parts():
+    # Cells that only touch at corners are not joined into one polygon
+    geometry = check_against_shapes(np.eye(5, dtype=bool))
+    assert len(geometry.geoms) == 5
+
+
+@pytest.mark.parametrize(
+    "mask_shape", [(1, 1), (1, 30), (30, 1), (13, 17), (64, 64), (101, 37)]
+)
+@pytest.mark.parametrize("density", [0.2, 0.5, 0.8])
+def test_polygonize_random(mask_shape, density):
+    rng = np.random.default_rng(mask_shape[0] * 1000 + mask_shape[1])
+    for _ in range(5):
+        mask = rng.random(mask_shape) < density
+        if mask.any():
+            check_against_shapes(mask)
@@ -0,0 +1,138 @@
+import numpy as np
+import pytest
+from rasterio import Affine
+from rasterio.windows import Window
+
+from fastws.raster import WindowAccumulator, get_transformer, transform_point
+
+
+# Raster origin and cell size used to construct accumulators
+TOP, LEFT, CSX, CSY = 600000.0, 1000000.0, 10.0, 20.0
+
+
+def tile_windows(shape, tile_shape):
+    """Windows of tiles covering a raster, where the last row and column are clipped"""
+    return [
+        Window(
+            col,
+            row,
+            min(tile_shape[1], shape[1] - col),
+            min(tile_shape[0], shape[0] - row),
+        )
+        for row in range(0, shape[0], tile_shape[0])
+        for col in range(0, shape[1], tile_shape[1])
+    ]
+
+
+def accumulate(reference, windows, rng):
+    """Mark the cells of a dense reference in an accumulator, one window at a time"""
+    accumulator = WindowAccumulator(TOP, LEFT, CSX, CSY, windows[0])
+
+    for window in windows:
+        i, j = np.nonzero(
+            reference[
+                window.row_off : window.row_off + window.height,
+                window.col_off : window.col_off + window.width,
+            ]
+        )
+        if i.size == 0:
+            continue
+
+        accumulator.add_window(window)
+
+        # Indices are repeated to ensure marks are idempotent
+        repeat = rng.integers(0, i.size, i.size // 2)
+        accumulator.set_indices(
+            window, np.concatenate([i, i[repeat]]), np.concatenate([j, j[repeat]])
+        )
+
+    return accumulator
+
+
+@pytest.mark.parametrize(
+    "shape, tile_shape",
+    [
+        ((250, 230), (64, 64)),
+        ((64, 64), (64, 64)),
+        ((7, 300), (5, 100)),
+        ((131, 67), (33, 13)),
+        ((1, 1), (64, 64)),
+    ],
+)
+@pytest.mark.parametrize("density", [0.002, 0.3, 1.0])
+def test_accumulator_round_trip(shape, tile_shape, density):
+    rng = np.random.default_rng(shape[0] * shape[1])
+    reference = rng.random(shape) < density
+    reference.flat[rng.integers(0, reference.size)] = True
+
+    windows = tile_windows(shape, tile_shape)
+    accumulator = accumulate(reference, windows, rng)
+
+    for window in accumulator.windows:
+        np.testing.assert_array_equal(
+            accumulator[window],
+            reference[
+                window.row_off : window.row_off + window.height,
+                window.col_off : window.col_off + window.width,
+            ],
+        )
+
+    # The crop covers the bounding box of marked cells only
+    rows = np.flatnonzero(reference.any(axis=1))
+    cols = np.flatnonzero(reference.any(axis=0))
+    data, transform = accumulator.crop(np.uint8)
+
+    assert data.dtype == np.uint8
+    np.testing.assert_array_equal(
+        data, reference[rows[0] : rows[-1] + 1, cols[0] : cols[-1] + 1]
+    )
+    assert transform == Affine(CSX, 0, LEFT, 0, -CSY, TOP) * Affine.translation(
+        cols[0], rows[0]
+    )
+
+
+def test_accumulator_single_cells():
+    window = Window(64, 128, 38, 58)
+    accumulator = WindowAccumulator(TOP, LEFT, CSX, CSY, window)
+
+    # Scalar indices on either side of word boundaries, including the last cell
+    reference = np.zeros((window.height, window.width), bool)
+    for bit in (0, 63, 64, 127, 128, window.height * window.width - 1):
+        i, j = divmod(bit, window.width)
+        accumulator.set_indices(window, i, j)
+        reference[i, j] = True
+
+        np.testing.assert_array_equal(accumulator[window], reference)
+
+    data, transform = accumulator.crop(bool)
+    np.testing.assert_array_equal(data, reference)
+    assert transform == Affine(CSX, 0, LEFT, 0, -CSY, TOP) * Affine.translation(
+        window.col_off, window.row_off
+    )
+
+
+def test_accumulator_empty_windows():
+    windows = tile_windows((128, 128), (64, 64))
+    accumulator = WindowAccumulator(TOP, LEFT, CSX, CSY, windows[0])
+    for window in windows:
+        accumulator.add_window(window)
+
+    # Windows without marks are not included in the crop
+    accumulator.set_indices(windows[3], 10, 20)
+    data, transform = accumulator.crop(np.uint8)
+
+    np.testing.assert_array_equal(data, [[1]])
+    assert transform == Affine(CSX, 0, LEFT, 0, -CSY, TOP) * Affine.translation(84, 74)
+
+
+@pytest.mark.filterwarnings("ignore:'\\+init")
+def test_transformer_spatial_references():
+    # Equivalent spatial references share a transformer
+    assert get_transformer(4326, "EPSG:3005") is get_transformer("EPSG:4326", 3005)
+
+    # Unhashable spatial references are accepted
+    x, y = transform_point(-120, 50, {"init": "epsg:4326"}, "EPSG:3005")
+    assert (x, y) == pytest.approx(transform_point(-120, 50, 4326, 3005))
+    assert get_transformer({"init": "epsg:4326"}, 3005) is get_transformer(
+        {"init": "epsg:4326"}, 3005
+    )